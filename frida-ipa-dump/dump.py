@@ -3,12 +3,17 @@
 
 from __future__ import print_function
 
-import codecs
+import atexit
+import logging
+import socket
 import sys
+import stat
 import tempfile
+import threading
 import os
 import shutil
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import frida
 
@@ -35,36 +40,99 @@ def find_app(app_name_or_id, device_id, device_ip):
     if dev.type not in ('tether', 'remote', 'usb'):
         fatal('unable to find device')
 
+    apps = dev.enumerate_applications()
     try:
-        app = next(app for app in dev.enumerate_applications() if
+        app = next(app for app in apps if
                    app_name_or_id == app.identifier or
                    app_name_or_id == app.name)
-    except:
+    except StopIteration:
         print('app "%s" not found' % app_name_or_id)
         print('installed app:')
-        for app in dev.enumerate_applications():
+        for app in apps:
             print('%s (%s)' % (app.name, app.identifier))
         fatal('')
 
     return dev, app
 
 
+BUF_SIZE = int(os.environ.get('IPA_DUMP_BUFSIZE', 1024 * 1024))
+
+# plugin sessions kept alive between dumps, (device id, identifier) ->
+# (session, pid, script)
+_SCRIPT_POOL = {}
+
+
+def _drain_script_pool():
+    for session, pid, script in _SCRIPT_POOL.values():
+        try:
+            session.detach()
+        except Exception:
+            pass
+    _SCRIPT_POOL.clear()
+
+
+atexit.register(_drain_script_pool)
+
+
+def fast_copy(src, dst, length=1 << 20):
+    # copy in MB-sized blocks, splicing in-kernel when the source is a
+    # regular file (sendfile cannot read from sockets or pipes)
+    try:
+        src_fd, dst_fd = src.fileno(), dst.fileno()
+        use_sendfile = hasattr(os, 'sendfile') and \
+            stat.S_ISREG(os.fstat(src_fd).st_mode)
+    except (AttributeError, OSError):
+        use_sendfile = False
+
+    if not use_sendfile:
+        shutil.copyfileobj(src, dst, length)
+        return
+
+    offset = 0
+    while True:
+        sent = os.sendfile(dst_fd, src_fd, offset, length)
+        if sent == 0:
+            break
+        offset += sent
+
+
 class Task(object):
 
     def __init__(self, session, path, size):
         self.session = session
         self.path = path
         self.size = size
-        self.file = open(self.path, 'wb')
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.written = 0
+        self._chunks = []
+        self._pending = 0
+        try:
+            os.posix_fallocate(self.fd, 0, size)
+        except (AttributeError, OSError):
+            os.ftruncate(self.fd, size)
 
     def write(self, data):
-        self.file.write(data)
+        self._chunks.append(data)
+        self._pending += len(data)
+        self.written += len(data)
+        if self._pending >= BUF_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self._chunks:
+            os.writev(self.fd, self._chunks)
+            self._chunks.clear()
+            self._pending = 0
 
     def finish(self):
+        self.flush()
+        if self.written != self.size:
+            os.ftruncate(self.fd, self.written)
+        os.fsync(self.fd)
         self.close()
 
     def close(self):
-        self.file.close()
+        os.close(self.fd)
 
 
 class IPADump(object):
@@ -75,18 +143,51 @@ class IPADump(object):
         self.session = None
         self.cwd = None
         self.tasks = {}
+        self._active_task = None
         self.output = output
         self.verbose = verbose
         self.opt = {
             'keepWatch': keep_watch,
         }
         self.ipa_name = ''
+        self._log = logging.getLogger('ipadump')
+        self._closer = ThreadPoolExecutor(max_workers=1)
+        self._close_futures = []
+        self._download_dispatch = {
+            'start': self.on_download_start,
+            'data': self.on_download_data,
+            'end': self.on_download_finish,
+            'error': self.on_download_error,
+        }
 
     def on_download_start(self, session, size, **kwargs):
-        self.tasks[session] = Task(session, self.ipa_name, size)
+        task = Task(session, self.ipa_name, size)
+        self.tasks[session] = task
+        # the common case is a single download; keep a direct reference
+        # so the data path skips hashing the session proxy
+        self._active_task = task if len(self.tasks) == 1 else None
+        # agents that can serve the stream over a local socket advertise a
+        # port; drain it on a thread instead of per-message data events
+        port = kwargs.get('port')
+        if port is not None:
+            task.drain_thread = threading.Thread(
+                target=self.drain_socket, args=(task, port))
+            task.drain_thread.start()
+
+    def drain_socket(self, task, port):
+        with socket.create_connection(('127.0.0.1', port)) as sock:
+            while True:
+                chunk = sock.recv(BUF_SIZE)
+                if not chunk:
+                    break
+                os.write(task.fd, chunk)
+                task.written += len(chunk)
 
     def on_download_data(self, session, data, **kwargs):
-        self.tasks[session].write(data)
+        task = self._active_task
+        if task is None:
+            task = self.tasks[session]
+        task.write(data)
 
     def on_download_finish(self, session, **kwargs):
         self.close_session(session)
@@ -95,40 +196,56 @@ class IPADump(object):
         self.close_session(session)
 
     def close_session(self, session):
-        self.tasks[session].finish()
-        del self.tasks[session]
+        task = self.tasks.pop(session)
+        self._active_task = next(iter(self.tasks.values())) \
+            if len(self.tasks) == 1 else None
+        drain = getattr(task, 'drain_thread', None)
+        if drain is not None:
+            drain.join()
+        # fsync and close can stall for seconds on a multi-hundred-MB
+        # file; run them off the message thread
+        self._close_futures.append(self._closer.submit(task.finish))
+
+    def wait_for_tasks(self):
+        for future in self._close_futures:
+            future.result()
+        del self._close_futures[:]
 
     def on_message(self, msg, data):
+        payload = msg.get('payload')
+        # fast path: during a dump nearly every message is a data chunk
+        if payload is not None and payload.get('event') == 'data' and \
+                payload.get('subject') == 'download':
+            task = self._active_task
+            if task is None:
+                task = self.tasks[payload['session']]
+            task.write(data)
+            return
+
         if msg.get('type') != 'send':
-            print('unknown message:', msg)
+            self._log.warning('unknown message: %s', msg)
             return
 
-        payload = msg.get('payload', {})
+        if payload is None:
+            payload = {}
         subject = payload.get('subject')
         if subject == 'download':
-            method_mapping = {
-                'start': self.on_download_start,
-                'data': self.on_download_data,
-                'end': self.on_download_finish,
-                'error': self.on_download_error,
-            }
-            method = method_mapping[payload.get('event')]
+            method = self._download_dispatch[payload.get('event')]
             method(data=data, **payload)
         elif subject == 'finish':
-            print('bye')
+            self._log.debug('bye')
+            self.wait_for_tasks()
             self.session.detach()
             sys.exit(0)
         else:
-            print('unknown message')
-            print(msg)
+            self._log.warning('unknown message: %s', msg)
 
     def dump(self):
         def on_console(level, text):
-            if not self.verbose and level == 'info':
-                return
-            print('[%s]' % level, text)
+            log = getattr(self._log, level, self._log.info)
+            log(text)
 
-        on_console('info', 'attaching to target')
+        self._log.debug('attaching to target')
         pid = self.app.pid
         spawn = not bool(pid)
         front = self.device.get_frontmost_application()
@@ -143,21 +260,24 @@ class IPADump(object):
         else:
             session = self.device.attach(pid)
 
+        self.session = session
         script = session.create_script(self.agent_source)
         script.set_log_handler(on_console)
         script.on('message', self.on_message)
         script.load()
 
-        self.plugins = script.exports.plugins()
+        exports = script.exports
+        self.plugins = exports.plugins()
         self.script = script
         if len(self.plugins):
             self.dump_with_plugins()
         else:
-            root = self.script.exports.root()
-            container = self.script.exports.data()+"/tmp"
-            decrypted = self.script.exports.decrypt(root, container)
-            self.script.exports.archive(root, container, decrypted, self.opt)
+            root = exports.root()
+            container = exports.data()+"/tmp"
+            decrypted = exports.decrypt(root, container)
+            exports.archive(root, container, decrypted, self.opt)
 
+        self.wait_for_tasks()
         session.detach()
 
     def dump_with_plugins(self):
@@ -174,45 +294,84 @@ class IPADump(object):
         pkd_script.exports.skip_pkd_validation_for(self.app.pid)
 
         Plugin = namedtuple('Plugin', ['id', 'session', 'pid', 'script'])
-        spawned = set()
-        all_groups = []
-        for identifier in self.plugins:
-            pid = self.script.exports.launch(identifier)
-            print('plugin %s, pid=%d' % (identifier, pid))
-            session = self.device.attach(pid)
-            script = session.create_script(self.agent_source)
-            script.load()
+        exports = self.script.exports
+        launch = exports.launch
+        compiled_lock = threading.Lock()
+        compiled = {}
+
+        def create_plugin_script(session):
+            # compile the agent once and reuse the bytecode for every
+            # plugin session; older frida bindings fall back to source
+            try:
+                with compiled_lock:
+                    if 'agent' not in compiled:
+                        compiled['agent'] = session.compile_script(
+                            self.agent_source, name='agent')
+                return session.create_script_from_bytes(compiled['agent'])
+            except (AttributeError, frida.NotSupportedError):
+                return session.create_script(self.agent_source)
+
+        def spawn_plugin(identifier):
+            pid = launch(identifier)
+            self._log.debug('plugin %s, pid=%d', identifier, pid)
+            pooled = _SCRIPT_POOL.pop((self.device.id, identifier), None)
+            if pooled is not None and pooled[1] == pid:
+                session, _, script = pooled
+            else:
+                session = self.device.attach(pid)
+                script = create_plugin_script(session)
+                script.load()
 
             plugin = Plugin(id=identifier, session=session, pid=pid, script=script)
-            spawned.add(plugin)
-            all_groups.append(set(script.exports.groups()))
+            return plugin, set(script.exports.groups())
+
+        spawned = set()
+        all_groups = []
+        with ThreadPoolExecutor(max_workers=len(self.plugins)) as executor:
+            for plugin, groups in executor.map(spawn_plugin, self.plugins):
+                spawned.add(plugin)
+                all_groups.append(groups)
 
         pkd.detach()
-        group = set.intersection(*all_groups).pop()
-        if not group:
+        smallest = min(all_groups, key=len)
+        group = next((g for g in smallest
+                      if all(g in groups for groups in all_groups)), None)
+        if group is None:
             raise RuntimeError('''App includes extension, but no valid '''
                                '''app group found. Please file a bug to Github''')
 
-        root = self.script.exports.root()
-        container = self.script.exports.path_for_group(group)
-        if self.verbose:
-            print('group:', group)
-            print('container:', container)
-            print('root:', root)
+        root = exports.root()
+        container = exports.path_for_group(group)
+        self._log.debug('group: %s', group)
+        self._log.debug('container: %s', container)
+        self._log.debug('root: %s', root)
         self.opt['dest'] = container
 
-        decrypted = self.script.exports.decrypt(root, container)
+        decrypted = list(exports.decrypt(root, container))
+        if spawned:
+            with ThreadPoolExecutor(max_workers=len(spawned)) as executor:
+                results = executor.map(
+                    lambda plugin: plugin.script.exports.decrypt(root, container),
+                    spawned)
+            for result in results:
+                decrypted.extend(result)
+
+        # keep sessions alive for the next dump instead of detach/kill
         for plugin in spawned:
-            decrypted += plugin.script.exports.decrypt(root, container)
-            plugin.session.detach()
-            self.device.kill(plugin.pid)
+            _SCRIPT_POOL[(self.device.id, plugin.id)] = \
+                (plugin.session, plugin.pid, plugin.script)
+
+        exports.archive(root, container, decrypted, self.opt)
 
-        self.script.exports.archive(root, container, decrypted, self.opt)
+    _agent_source = None
 
     def load_agent(self):
-        agent = os.path.join('agent', 'dist.js')
-        with codecs.open(agent, 'r', 'utf-8') as fp:
-            self.agent_source = fp.read()
+        cls = type(self)
+        if cls._agent_source is None:
+            agent = os.path.join('agent', 'dist.js')
+            with open(agent, 'rb') as fp:
+                cls._agent_source = fp.read().decode('utf-8')
+        self.agent_source = cls._agent_source
 
     def run(self):
         self.load_agent()
@@ -241,6 +400,9 @@ def main():
                         default=False, help='preserve WatchOS app')
     args = parser.parse_args()
 
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.WARNING)
+
     dev, app = find_app(args.app, args.device, args.ip)
 
     task = IPADump(dev, app,